@@ -0,0 +1,5 @@
+import sys
+
+from .dyn4 import main
+
+sys.exit(main())
@@ -23,8 +23,13 @@
 
 from __future__ import print_function
 
+import os
 import sys
 import time
+import select
+import random
+import argparse
+import collections
 import serial
 
 import numpy as np
@@ -77,14 +82,16 @@ class DMMExceptionUnexpectedFunc(DMMException):
         DMMException.__init__(self)
 
 
+class DMMExceptionChecksum(DMMException):
+    def __init__(self, arr):
+        DMMException.__init__(self)
+        self.arr = arr
+
+
 class DMMDrive:
     def __init__(self, serial_dev, drive_id):
-        self.serial = serial.Serial(serial_dev,
-                                    38400,
-                                    timeout=None,
-                                    parity=serial.PARITY_NONE,
-                                    stopbits=serial.STOPBITS_ONE,
-                                    bytesize=serial.EIGHTBITS)
+        self.serial_dev = None
+        self.open(serial_dev)
         self.drive_id = drive_id
 
         # print(dir(self.serial))
@@ -97,6 +104,35 @@ class DMMDrive:
 
         self.torque_arr = []
 
+        # (lost, restored) times of interruptions in the connection
+        self.gaps = []
+
+        # (time, {register: value}) samples from monitoring, (time, None) marks where a gap began
+        self.samples = collections.deque()
+
+    def open(self, serial_dev):
+        if hasattr(serial_dev, 'read'):
+            # Already opened port-like object, e.g. SimulatedSerial
+            self.serial = serial_dev
+        else:
+            self.serial = serial.Serial(serial_dev,
+                                        38400,
+                                        timeout=None,
+                                        parity=serial.PARITY_NONE,
+                                        stopbits=serial.STOPBITS_ONE,
+                                        bytesize=serial.EIGHTBITS)
+            self.serial_dev = serial_dev
+
+    def reopen(self):
+        # Reopen the same device in place, keeping torque_arr, samples and gaps
+        if self.serial_dev is None:
+            raise ValueError('cannot reopen a drive that was not opened from a device path')
+        try:
+            self.serial.close()
+        except (serial.serialutil.SerialException, OSError):
+            pass
+        self.open(self.serial_dev)
+        self.flush()
 
     def __enter__(self):
         return self
@@ -268,7 +304,7 @@ class DMMDrive:
             func_id, v = self.read_response()
             if func_id == expected_func_id:
                 break
-        if i == max_attempts:
+        else:
             raise DMMExceptionUnexpectedFunc()
 
         return v
@@ -348,7 +384,8 @@ class DMMDrive:
                 print(hex(func_id))
             if crc_check:
                 if 0x00 <= func_id <= 0x0a or 0x1e < func_id:
-                    print('Unallowed address read:', func_id)
+                    # Unallowed address read
+                    raise DMMExceptionUnknownFunctionID(func_id)
                 elif func_id == 0x10:
                     # Is_MainGain
                     verify_length(arr, 0)
@@ -457,7 +494,8 @@ class DMMDrive:
                     # Is_Config
                     verify_length(arr, 0)
                     x = arr[2] & 0x7f
-                    print(hex(x))
+                    if self.debug:
+                        print(hex(x))
                     d = {}
 
                     x2 = x & 0x03
@@ -512,13 +550,17 @@ class DMMDrive:
                     # Is_AbsPos32
                     x = self.read_signed_val(arr)
 
-                elif func_id in [0x1c, 0x1d]:
-                    print('Unknown address read:', func_id)
-
                 elif func_id == 0x1e:
                     # Is_TrqCurrent
                     x = self.read_signed_val(arr)
 
+                else:
+                    # Unknown address read, 0x0b-0x0f, 0x1c, 0x1d
+                    raise DMMExceptionUnknownFunctionID(func_id)
+
+            else:
+                raise DMMExceptionChecksum(arr)
+
         return func_id, x
 
     def read_signed_val(self, arr):
@@ -611,7 +653,98 @@ class DMMDrive:
         return np.mean(arr), arr[-1]
 
 
-def find_device():
+class SimulatedSerial:
+    """Stand-in for serial.Serial that answers read commands like a DYN4 drive.
+
+    Only the read commands are simulated; set commands are accepted and ignored.
+    latency is the round trip time in seconds added to each response.
+    """
+
+    # Read command sent by the host -> function id of the drive's response
+    read_fids = {
+        0x06: 0x16,  # Read_Drive_ID -> Is_Drive_ID
+        0x08: 0x1a,  # Read_Drive_Config -> Is_Config
+        0x09: 0x19,  # Read_Drive_Status -> Is_Status
+        0x18: 0x10,  # Read_MainGain -> Is_MainGain
+        0x19: 0x11,  # Read_SpeedGain -> Is_SpeedGain
+        0x1a: 0x12,  # Read_IntGain -> Is_IntGain
+        0x1b: 0x13,  # Read_TrqCons -> Is_TrqCons
+        0x1c: 0x14,  # Read_HighSpeed -> Is_HighSpeed
+        0x1d: 0x15,  # Read_HighAccel -> Is_HighAccel
+        0x1e: 0x17,  # Read_Pos_OnRange -> Is_Pos_OnRange
+        0x1f: 0x18}  # Read_GearNumber -> Is_GearNumber
+
+    def __init__(self, latency=0.):
+        self.timeout = None
+        self.latency = latency
+        self.rx = bytearray()
+        self.registers = {
+            0x10: 40,  # Is_MainGain
+            0x11: 20,  # Is_SpeedGain
+            0x12: 5,  # Is_IntGain
+            0x13: 63,  # Is_TrqCons
+            0x14: 30,  # Is_HighSpeed
+            0x15: 30,  # Is_HighAccel
+            0x17: 10,  # Is_Pos_OnRange
+            0x18: [4096, 4096],  # Is_GearNumber
+            0x19: 0x00,  # Is_Status
+            0x1a: 0x23,  # Is_Config, analog, enabled
+            0x1b: 0}  # Is_AbsPos32
+
+    def write(self, data):
+        packet = bytearray(data)
+        while len(packet) >= 2:
+            n = 4 + ((packet[1] >> 5) & 0x03)
+            drive_id = packet[0] & 0x7f
+            func_id2 = packet[1] & 0x1f
+            if func_id2 == 0x0e:
+                # General_Read
+                self.respond(drive_id, packet[2] & 0x7f)
+            elif func_id2 in self.read_fids:
+                self.respond(drive_id, self.read_fids[func_id2])
+            packet = packet[n:]
+        return len(data)
+
+    def respond(self, drive_id, func_id):
+        if func_id == 0x16:
+            data = [drive_id]
+        elif func_id == 0x18:
+            a, b = self.registers[func_id]
+            data = [a >> 7, a, b >> 7, b]
+        elif func_id == 0x1b:
+            v = self.registers[func_id]
+            data = [v >> 21, v >> 14, v >> 7, v]
+        elif func_id == 0x1e:
+            v = random.randint(-200, 200)
+            data = [v >> 7, v]
+        else:
+            data = [self.registers[func_id]]
+
+        packet = [drive_id & 0x7f,
+                  0x80 | ((len(data) - 1) << 5) | func_id]
+        packet += [0x80 | (x & 0x7f) for x in data]
+        packet += [0x80 | (sum(packet) & 0x7f)]
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.rx += bytearray(packet)
+
+    def read(self, size=1):
+        x = bytes(self.rx[:size])
+        del self.rx[:size]
+        return x
+
+    def reset_input_buffer(self):
+        self.rx = bytearray()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        pass
+
+
+def find_device(verbose=True):
     devs = []
 
     global serial
@@ -627,71 +760,320 @@ def find_device():
         devs = glob.glob('/dev/ttyUSB*')
 
     if not devs:
-        print('No known serial devices found.')
+        if verbose:
+            print('No known serial devices found.')
         return ''
 
-    if len(devs) > 1:
+    if len(devs) > 1 and verbose:
         print('More than one serial devices found...')
         for dev in devs:
             print(dev)
         print('Selecting first serial device.')
 
-    print('Using device at:', devs[0])
+    if verbose:
+        print('Using device at:', devs[0])
     return devs[0]
 
 
-def serial_loop(dev_fn):
-    with DMMDrive(dev_fn, 0) as dmm:
-        d = {}
-        d['Status'] = dmm.read_Status()
+def stable_device(dev_fn, by_id='/dev/serial/by-id'):
+    # ttyUSB numbers can change when an adapter reconnects, the by-id link follows the adapter
+    try:
+        for fn in sorted(os.listdir(by_id)):
+            link = os.path.join(by_id, fn)
+            if os.path.realpath(link) == os.path.realpath(dev_fn):
+                return link
+    except OSError:
+        pass
+    return dev_fn
 
-        d['MainGain'] = dmm.read_MainGain()
-        d['SpeedGain'] = dmm.read_SpeedGain()
-        d['IntGain'] = dmm.read_IntGain()
-        d['TrqCons'] = dmm.read_TrqCons()
-        d['HighSpeed'] = dmm.read_HighSpeed()
-        d['HighAccel'] = dmm.read_HighAccel()
-        d['Pos_OnRange'] = dmm.read_Pos_OnRange()
-        d['GearNumber'] = dmm.read_GearNumber()
-        d['Status'] = dmm.read_Status()
-        d['Config'] = dmm.read_Config()
-        d['AbsPos32'] = dmm.read_AbsPos32()
-        d['TrqCurrent'] = dmm.read_TrqCurrent()
 
-        if True:
-            dmm.set_speed(50)
+class DeviceWatcher:
+    """Wakes up when device nodes are added to, removed from or changed in /dev.
 
-            time.sleep(.5)
-            d['Speed'] = dmm.measure_speed()
+    Uses inotify when available, otherwise wait() sleeps for poll_interval.
+    """
 
-            print(d)
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
 
-            while True:
-                time.sleep(.5)
-                print(dmm.measure_speed())
+    def __init__(self, dirs=('/dev', '/dev/serial/by-id'), poll_interval=.05):
+        self.dirs = dirs
+        self.poll_interval = poll_interval
+        self.fd = -1
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                import ctypes.util
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                self.fd = self.libc.inotify_init()
+            except (OSError, AttributeError, TypeError):
+                pass
 
-                dmm.integrate_TrqCurrent()
+        if self.fd >= 0:
+            self.add_watches()
 
-       
-def main():
-    try:
-        while True:
-            dev_fn = find_device()
-            if dev_fn:
-                try:
-                    serial_loop(dev_fn)
-                except DMMTimeout:
-                    print('Timedout')
-                    # raise
-                except serial.serialutil.SerialException as e:
-                    # SerialException: could not open port /dev/ttyUSB1: [Errno 2] No such file or directory: '/dev/ttyUSB1'
-                    # SerialException: device reports readiness to read but returned no data (device disconnected?)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watches(self):
+        mask = self.IN_ATTRIB | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        for d in self.dirs:
+            # by-id is removed with the last adapter, until it is recreated watch its nearest
+            # existing parent. Watches are re-added after every wake up, adding an existing
+            # watch again is harmless.
+            while not os.path.isdir(d) and os.path.dirname(d) != d:
+                d = os.path.dirname(d)
+            self.libc.inotify_add_watch(self.fd, d.encode(), mask)
+
+    def wait(self, timeout):
+        if self.fd < 0:
+            time.sleep(min(timeout, self.poll_interval))
+            return
+
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if r:
+            os.read(self.fd, 4096)
+        self.add_watches()
+
+
+def reconnect(dmm, watcher, retry_interval=.5):
+    # Wait for the adapter to reappear and reopen it in place. Opening can fail for a
+    # moment after the node appears, until udev has set its permissions (IN_ATTRIB).
+    # retry_interval is only a backstop in case an event is missed.
+    while True:
+        if os.path.exists(dmm.serial_dev):
+            try:
+                dmm.reopen()
+                return
+            except (serial.serialutil.SerialException, OSError):
+                pass
+        watcher.wait(retry_interval)
+
+
+# Registers that can be read without changing the state of the drive
+registers = ['MainGain', 'SpeedGain', 'IntGain', 'TrqCons', 'HighSpeed', 'HighAccel', 'Pos_OnRange',
+             'GearNumber', 'Status', 'Config', 'AbsPos32', 'TrqCurrent']
+
+
+def read_register(dmm, name):
+    return getattr(dmm, 'read_' + name)()
+
+
+def open_drive(args, watcher=None):
+    # With a watcher, wait for the device to appear instead of giving up
+    if args.simulate:
+        return DMMDrive(SimulatedSerial(args.latency), args.drive_id)
+
+    waiting = False
+    while True:
+        dev_fn = args.port or find_device(verbose=not waiting)
+        if dev_fn:
+            try:
+                dmm = DMMDrive(stable_device(dev_fn), args.drive_id)
+                if waiting:
+                    print('Using device at:', dev_fn)
+                return dmm
+            except (serial.serialutil.SerialException, OSError) as e:
+                if watcher is None:
+                    raise
+                if not waiting:
                     print('SerialException:', e)
-            print('Kicked out... resting before retrying.')
-            time.sleep(1)
+        elif watcher is None:
+            return None
+
+        if not waiting:
+            print('Waiting for device...')
+            waiting = True
+        watcher.wait(1.)
+
+
+def cmd_dump(dmm, args):
+    for name in args.registers:
+        print('{}: {}'.format(name, read_register(dmm, name)))
+
+
+def cmd_monitor(dmm, args):
+    # args.watcher is None when there is no device to reconnect to, e.g. --simulate
+    watcher = args.watcher
+    period = 1. / args.rate
+    lost_t = None
+    i = 0
+    next_t = time.time()
+    while args.count is None or i < args.count:
+        t = time.time()
+        try:
+            vals = [read_register(dmm, name) for name in args.registers]
+        except DMMTimeout:
+            if lost_t is None:
+                lost_t = t
+            if watcher is not None and not os.path.exists(dmm.serial_dev):
+                reconnect(dmm, watcher)
+            # Otherwise the port is still there, keep polling until the drive answers again
+            continue
+        except DMMException:
+            # Corrupted or unexpected frame, drop whatever else is in flight and keep polling
+            if lost_t is None:
+                lost_t = t
+            dmm.flush()
+            continue
+        except (serial.serialutil.SerialException, OSError) as e:
+            # SerialException: device reports readiness to read but returned no data (device disconnected?)
+            if watcher is None:
+                raise
+            if lost_t is None:
+                lost_t = t
+            print('SerialException:', e)
+            reconnect(dmm, watcher)
+            continue
+
+        if lost_t is not None:
+            dmm.gaps += [(lost_t, t)]
+            dmm.samples.append((lost_t, None))
+            print('{:.3f} gap {:.3f}s'.format(lost_t, t - lost_t))
+            lost_t = None
+            next_t = t
+
+        dmm.samples.append((t, dict(zip(args.registers, vals))))
+        while t - dmm.samples[0][0] > args.history:
+            dmm.samples.popleft()
+
+        print('{:.3f}'.format(t), ' '.join('{}={}'.format(k, v) for k, v in zip(args.registers, vals)))
+        sys.stdout.flush()
+        i += 1
+
+        next_t += period
+        dt = next_t - time.time()
+        if dt > 0:
+            time.sleep(dt)
+        else:
+            # Fell behind, don't try to catch up with a burst of reads
+            next_t = time.time()
+
+
+def cmd_bench(dmm, args):
+    print('{:<12} {:>6} {:>10} {:>9} {:>9} {:>7}'.format('register', 'reads', 'reads/sec', 'p50 ms', 'p99 ms', 'errors'))
+    total_n = 0
+    total_dt = 0.
+    for name in args.registers:
+        rtts = []
+        errors = 0
+        st = time.time()
+        for _ in range(args.count):
+            t0 = time.time()
+            try:
+                read_register(dmm, name)
+            except DMMException:
+                errors += 1
+                dmm.flush()
+                continue
+            rtts += [time.time() - t0]
+        dt = time.time() - st
+
+        total_n += len(rtts)
+        total_dt += dt
+
+        if rtts:
+            p50, p99 = np.percentile(rtts, [50, 99]) * 1000.
+            print('{:<12} {:>6} {:>10.1f} {:>9.3f} {:>9.3f} {:>7}'.format(name, len(rtts), len(rtts) / dt, p50, p99, errors))
+        else:
+            print('{:<12} {:>6} {:>10} {:>9} {:>9} {:>7}'.format(name, 0, '-', '-', '-', errors))
+
+    if total_dt > 0:
+        print('{:<12} {:>6} {:>10.1f}'.format('total', total_n, total_n / total_dt))
+
+
+def register_list(s):
+    names = [x for x in s.split(',') if x]
+    for name in names:
+        if name not in registers:
+            raise argparse.ArgumentTypeError('unknown register: {} (choose from {})'.format(name, ', '.join(registers)))
+    return names
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='dmm-dyn4',
+                                     description='Read status of a DMM DYN4 servo drive. All commands are read-only.')
+    parser.add_argument('--port', help='serial device, default is to search for a known adapter')
+    parser.add_argument('--simulate', action='store_true', help='use a simulated drive instead of a serial port')
+    parser.add_argument('--latency', type=float, default=0., help='simulated round trip time in seconds')
+    parser.add_argument('--drive-id', type=int, default=0, help='drive id (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', help='print packets')
+    parser.set_defaults(watcher=None)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('dump', help='read every register once')
+    p.set_defaults(func=cmd_dump, registers=registers)
+
+    p = subparsers.add_parser('monitor', help='repeatedly read selected registers')
+    p.add_argument('-r', '--registers', type=register_list, default=['TrqCurrent'],
+                   help='comma separated registers (default: TrqCurrent)')
+    p.add_argument('--rate', type=float, default=10., help='target reads per second (default: %(default)s)')
+    p.add_argument('-n', '--count', type=int, help='stop after this many samples')
+    p.add_argument('--history', type=float, default=60., help='seconds of samples kept in memory (default: %(default)s)')
+    p.set_defaults(func=cmd_monitor)
+
+    p = subparsers.add_parser('bench', help='measure read rate and round trip latency')
+    p.add_argument('-r', '--registers', type=register_list, default=registers,
+                   help='comma separated registers (default: all)')
+    p.add_argument('-n', '--count', type=int, default=200, help='reads per register (default: %(default)s)')
+    p.set_defaults(func=cmd_bench)
+
+    args = parser.parse_args(argv)
+    if not args.registers:
+        parser.error('no registers given')
+    if args.command == 'monitor' and args.rate <= 0:
+        parser.error('--rate must be positive')
+    if args.command == 'monitor' and args.history <= 0:
+        parser.error('--history must be positive')
+    if args.command in ('monitor', 'bench') and args.count is not None and args.count < 1:
+        parser.error('--count must be at least 1')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'monitor' and not args.simulate:
+        # Wait for the adapter at startup and after a glitch
+        args.watcher = DeviceWatcher()
+
+    try:
+        dmm = open_drive(args, args.watcher)
+        if dmm is None:
+            return 1
+        with dmm:
+            dmm.debug = args.debug
+            args.func(dmm, args)
+    except DMMTimeout:
+        print('Timedout')
+        return 1
+    except DMMException as e:
+        print('DMMException:', type(e).__name__)
+        return 1
+    except serial.serialutil.SerialException as e:
+        # SerialException: could not open port /dev/ttyUSB1: [Errno 2] No such file or directory: '/dev/ttyUSB1'
+        # SerialException: device reports readiness to read but returned no data (device disconnected?)
+        print('SerialException:', e)
+        return 1
     except KeyboardInterrupt:
         pass
+    finally:
+        if args.watcher is not None:
+            args.watcher.close()
+
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import argparse
+
+import pytest
+
+import dmm_dyn4.dyn4 as dyn4
+from dmm_dyn4.dyn4 import (DMMDrive, DMMExceptionChecksum, DMMExceptionUnexpectedFunc, DMMExceptionUnknownFunctionID,
+                           SimulatedSerial, cmd_bench, cmd_monitor, main, parse_args, register_list, registers)
+
+
+class BadChecksumSerial(SimulatedSerial):
+    # Corrupts the checksum of the first n_bad responses, or all of them when n_bad is None
+    def __init__(self, latency=0., n_bad=None):
+        SimulatedSerial.__init__(self, latency)
+        self.n_bad = n_bad
+
+    def respond(self, drive_id, func_id):
+        SimulatedSerial.respond(self, drive_id, func_id)
+        if self.n_bad is None or self.n_bad > 0:
+            self.rx[-1] ^= 0x01
+            if self.n_bad is not None:
+                self.n_bad -= 1
+
+
+def test_simulated_registers():
+    dmm = DMMDrive(SimulatedSerial(), 0)
+    assert dmm.read_MainGain() == 40
+    assert dmm.read_Pos_OnRange() == 10
+    assert dmm.read_GearNumber() == [4096, 4096]
+    assert dmm.read_Status()['alarm'] == ''
+    assert dmm.read_Config() == {'input mode': 'analog', 'positioning': 'relative', 'servo mode': 'position',
+                                 'enabled': 'yes', 'b6': '0 TBD'}
+    assert -200 <= dmm.read_TrqCurrent() <= 200
+
+
+@pytest.mark.parametrize('pos', [0, 1, -1, 12345678, -12345678])
+def test_simulated_abs_pos(pos):
+    ser = SimulatedSerial()
+    ser.registers[0x1b] = pos
+    dmm = DMMDrive(ser, 3)
+    assert dmm.read_AbsPos32() == pos
+
+
+def test_checksum_error():
+    dmm = DMMDrive(BadChecksumSerial(), 0)
+    with pytest.raises(DMMExceptionChecksum):
+        dmm.read_MainGain()
+    with pytest.raises(DMMExceptionChecksum):
+        dmm.read_Status()
+
+
+def test_unknown_function_id():
+    ser = SimulatedSerial()
+    ser.registers[0x1c] = 0
+    ser.read_fids = dict(ser.read_fids)
+    ser.read_fids[0x1c] = 0x1c
+    dmm = DMMDrive(ser, 0)
+    with pytest.raises(DMMExceptionUnknownFunctionID):
+        dmm.read_HighSpeed()
+
+
+def test_wrong_function_id():
+    ser = SimulatedSerial()
+    ser.read_fids = dict(ser.read_fids)
+    ser.read_fids[0x18] = 0x11  # Read_MainGain answered with Is_SpeedGain
+    dmm = DMMDrive(ser, 0)
+    # Two stale frames ahead of the wrong answer, check_response gives up after three
+    ser.respond(0, 0x11)
+    ser.respond(0, 0x11)
+    with pytest.raises(DMMExceptionUnexpectedFunc):
+        dmm.read_MainGain()
+    assert dmm.read_SpeedGain() == 20
+
+
+def test_monitor_survives_checksum_error():
+    dmm = DMMDrive(BadChecksumSerial(n_bad=2), 0)
+    cmd_monitor(dmm, argparse.Namespace(registers=['MainGain'], rate=100., count=3, history=60., watcher=None))
+    assert [v[1] for v in dmm.samples][1:] == [{'MainGain': 40}] * 3
+    assert dmm.samples[0][1] is None
+    assert len(dmm.gaps) == 1
+
+
+def test_main_reports_checksum_error(monkeypatch, capsys):
+    monkeypatch.setattr(dyn4, 'SimulatedSerial', BadChecksumSerial)
+    assert main(['--simulate', 'dump']) == 1
+    assert 'DMMExceptionChecksum' in capsys.readouterr().out
+
+
+def test_bench_counts_checksum_errors(capsys):
+    dmm = DMMDrive(BadChecksumSerial(), 0)
+    cmd_bench(dmm, argparse.Namespace(registers=['MainGain'], count=5))
+    row = [line.split() for line in capsys.readouterr().out.splitlines() if line.startswith('MainGain')][0]
+    assert row[1] == '0'
+    assert row[-1] == '5'
+
+
+def test_register_list():
+    assert register_list('TrqCurrent,AbsPos32') == ['TrqCurrent', 'AbsPos32']
+    with pytest.raises(argparse.ArgumentTypeError):
+        register_list('TrqCurrent,Bogus')
+
+
+def test_parse_args():
+    args = parse_args(['--simulate', 'dump'])
+    assert args.registers == registers
+    assert parse_args(['bench', '-n', '1']).count == 1
+
+
+@pytest.mark.parametrize('argv', [['monitor', '-r', ','],
+                                  ['bench', '-r', ''],
+                                  ['bench', '-n', '0'],
+                                  ['monitor', '-n', '-1'],
+                                  ['monitor', '--rate', '0']])
+def test_parse_args_rejects(argv):
+    with pytest.raises(SystemExit):
+        parse_args(argv)
@@ -0,0 +1,185 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import dmm_dyn4.dyn4 as dyn4
+from dmm_dyn4.dyn4 import DMMDrive, DeviceWatcher, SimulatedSerial, cmd_monitor, open_drive, reconnect, stable_device
+
+
+class FileSerial(SimulatedSerial):
+    """Simulated drive behind a device node that can be removed and recreated."""
+
+    def __init__(self, fn, *args, **kwargs):
+        if not os.path.exists(fn):
+            raise dyn4.serial.serialutil.SerialException('could not open port {}'.format(fn))
+        SimulatedSerial.__init__(self)
+        self.fn = fn
+
+    def read(self, size=1):
+        if not os.path.exists(self.fn):
+            raise dyn4.serial.serialutil.SerialException('device reports readiness to read but returned no data')
+        return SimulatedSerial.read(self, size)
+
+
+@pytest.fixture
+def dev(tmpdir, monkeypatch):
+    monkeypatch.setattr(dyn4.serial, 'Serial', FileSerial)
+    fn = str(tmpdir.join('ttyUSB0'))
+    open(fn, 'w').close()
+    return fn
+
+
+def recreate_later(fn, delay):
+    def f():
+        time.sleep(delay)
+        open(fn, 'w').close()
+    th = threading.Thread(target=f)
+    th.start()
+    return th
+
+
+def monitor_args(watcher, count):
+    return argparse.Namespace(registers=['TrqCurrent'], rate=50., count=count, history=60., watcher=watcher)
+
+
+def test_stable_device(tmpdir):
+    tty = tmpdir.join('ttyUSB3')
+    tty.write('')
+    by_id = tmpdir.mkdir('by-id')
+    link = by_id.join('usb-FTDI_FT230X_Basic_UART_D30-if00-port0')
+    os.symlink(str(tty), str(link))
+    assert stable_device(str(tty), str(by_id)) == str(link)
+    assert stable_device(str(tmpdir.join('ttyUSB4')), str(by_id)) == str(tmpdir.join('ttyUSB4'))
+    assert stable_device(str(tty), str(tmpdir.join('missing'))) == str(tty)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_watcher_wakes_on_create(tmpdir):
+    with DeviceWatcher(dirs=(str(tmpdir),)) as watcher:
+        assert watcher.fd >= 0
+        th = recreate_later(str(tmpdir.join('ttyUSB0')), .05)
+        st = time.time()
+        watcher.wait(5.)
+        assert time.time() - st < 1.
+        th.join()
+    assert watcher.fd == -1
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_watcher_by_id_recreated(tmpdir, dev):
+    # udev removes /dev/serial/by-id with the last adapter and recreates the directories
+    # one level at a time before adding the link
+    by_id = os.path.join(str(tmpdir), 'serial', 'by-id')
+    link = os.path.join(by_id, 'usb-FTDI_FT230X_Basic_UART_D30-if00-port0')
+    os.makedirs(by_id)
+    os.symlink(dev, link)
+    dmm = DMMDrive(link, 0)
+    os.remove(link)
+    os.rmdir(by_id)
+    os.rmdir(os.path.dirname(by_id))
+
+    created = {}
+
+    def replug():
+        time.sleep(.05)
+        os.mkdir(os.path.dirname(by_id))
+        time.sleep(.02)
+        os.mkdir(by_id)
+        time.sleep(.02)
+        os.symlink(dev, link)
+        created['t'] = time.time()
+
+    with DeviceWatcher(dirs=(str(tmpdir), by_id)) as watcher:
+        th = threading.Thread(target=replug)
+        th.start()
+        reconnect(dmm, watcher)
+        th.join()
+    # Well under the .5s retry_interval backstop
+    assert time.time() - created['t'] < .2
+    assert dmm.read_MainGain() == 40
+
+
+def test_watcher_fallback(tmpdir):
+    watcher = DeviceWatcher(dirs=(str(tmpdir),), poll_interval=.01)
+    watcher.close()
+    st = time.time()
+    watcher.wait(5.)
+    assert time.time() - st < 1.
+
+
+def test_reopen_needs_device_path():
+    dmm = DMMDrive(SimulatedSerial(), 0)
+    with pytest.raises(ValueError):
+        dmm.reopen()
+    assert dmm.read_MainGain() == 40
+
+
+def test_reconnect(tmpdir, dev):
+    dmm = DMMDrive(dev, 0)
+    old = dmm.serial
+    os.remove(dev)
+    with DeviceWatcher(dirs=(str(tmpdir),)) as watcher:
+        th = recreate_later(dev, .05)
+        reconnect(dmm, watcher)
+        th.join()
+    assert dmm.serial is not old
+    assert dmm.read_MainGain() == 40
+
+
+def test_monitor_marks_gap(tmpdir, dev):
+    dmm = DMMDrive(dev, 0)
+    dmm.torque_arr = [(0., 1)]
+
+    def glitch():
+        time.sleep(.05)
+        os.remove(dev)
+        time.sleep(.1)
+        open(dev, 'w').close()
+    th = threading.Thread(target=glitch)
+    th.start()
+
+    with DeviceWatcher(dirs=(str(tmpdir),)) as watcher:
+        cmd_monitor(dmm, monitor_args(watcher, 10))
+    th.join()
+
+    assert len(dmm.gaps) == 1
+    lost_t, restored_t = dmm.gaps[0]
+    assert restored_t - lost_t >= .05
+    assert dmm.torque_arr == [(0., 1)]
+    assert len([v for v in dmm.samples if v[1] is not None]) == 10
+    markers = [i for i, v in enumerate(dmm.samples) if v[1] is None]
+    assert len(markers) == 1
+    assert dmm.samples[markers[0]][0] == lost_t
+    assert 0 < markers[0] < len(dmm.samples) - 1
+
+
+def test_monitor_without_watcher_raises(dev):
+    dmm = DMMDrive(dev, 0)
+    os.remove(dev)
+    with pytest.raises(dyn4.serial.serialutil.SerialException):
+        cmd_monitor(dmm, monitor_args(None, 1))
+
+
+def test_monitor_schedule():
+    dmm = DMMDrive(SimulatedSerial(), 0)
+    cmd_monitor(dmm, monitor_args(None, 3))
+    times = [v[0] for v in dmm.samples]
+    assert times[1] - times[0] >= .015
+
+
+def test_open_drive_waits_for_device(tmpdir, dev):
+    os.remove(dev)
+    args = argparse.Namespace(simulate=False, port=dev, drive_id=0)
+    with pytest.raises(dyn4.serial.serialutil.SerialException):
+        open_drive(args)
+
+    with DeviceWatcher(dirs=(str(tmpdir),)) as watcher:
+        th = recreate_later(dev, .05)
+        dmm = open_drive(args, watcher)
+        th.join()
+    assert dmm.serial_dev == dev
+    assert dmm.read_MainGain() == 40